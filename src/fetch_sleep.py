@@ -1,27 +1,40 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import io
+import os
+import sys
 import fitbit
 import json
 import datetime as dt
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from fitbit.exceptions import HTTPException
 from oauthlib.oauth2 import LegacyApplicationClient
 from requests_oauthlib import OAuth2Session
 
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 
-CREDS_FILE = '../config/fitbit_creds.json'
-TOKEN_FILE = '../config/fitbit_token.json'
+# パスはモジュール読み込み時に一度だけ解決する（実行時のカレントディレクトリに依存しない）
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_DIR = os.path.join(BASE_DIR, 'config')
+DATA_DIR = os.path.join(BASE_DIR, 'data')
 
-OUT_FILE = "../data/sleep_master.csv"
+CREDS_FILE = os.path.join(CONFIG_DIR, 'fitbit_creds.json')
+TOKEN_FILE = os.path.join(CONFIG_DIR, 'fitbit_token.json')
+
+OUT_FILE = os.path.join(DATA_DIR, 'sleep_master.csv')
+
+# 毎回取得し直す日数
+FETCH_DAYS = 14
+
+# Fitbit APIへの同時リクエスト数
+MAX_WORKERS = 4
 
 # tokenファイルを上書きする関数
 def update_token(token):
-    f = open(TOKEN_FILE, 'w')
-    f.write(str(token))
-    f.close()
-    return
+    with open(TOKEN_FILE, 'wb') as f:
+        f.write(json.dumps(token).encode('utf-8'))
 
 # トークン情報をファイルから読み込む
 with open(TOKEN_FILE, 'r') as f:
@@ -39,6 +52,10 @@ client = fitbit.Fitbit(creds['client_id'],
                        refresh_cb=update_token)
 
 def json_to_row(data):    
+    # 睡眠ログがない日（未装着・未同期）は None を返してスキップする
+    if not data['sleep']:
+        return None
+
     sleep = data['sleep'][0]
     summary = data['summary']
     stages = summary['stages']
@@ -54,23 +71,82 @@ def json_to_row(data):
             "wakeStage": stages['wake']}
 
 
-# 現在の日付から一ヶ月前の日付を取得
+# 通信・APIエラーの日は例外を返し、他の日の結果は捨てない
+# （レスポンスのパースに失敗した場合はそのまま例外を送出する）
+def fetch_sleep_row(date):
+    try:
+        sleep_log = client.sleep(date=date)
+    except (requests.RequestException, HTTPException) as e:
+        return None, e
+    return json_to_row(sleep_log), None
+
+
+# 直近 FETCH_DAYS 日分は毎回取得し直す（遅れて同期されたデータや再計算を反映するため）
 end_date = dt.date.today()
-start_date = end_date - dt.timedelta(days=14)
+start_date = end_date - dt.timedelta(days=FETCH_DAYS)
+
+dates = [start_date + dt.timedelta(days=n)
+         for n in range((end_date - start_date).days + 1)]
+
+# 最初の1日はトークン更新が並列に走らないよう逐次で取得し、残りはスレッドで並列取得
+results = [fetch_sleep_row(dates[0])]
+if results[0][1] is None:
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results.extend(executor.map(fetch_sleep_row, dates[1:]))
 
-# 一ヶ月分の睡眠データを取得
+# 取得に失敗した日は表示だけして、取得できた日の分は保存する
 sleep_data = []
-current_date = start_date
-while current_date <= end_date:
-    sleep_log = client.sleep(date=current_date)
-    sleep_data.append(json_to_row(sleep_log))
-    current_date += dt.timedelta(days=1)
+failed = False
+for date, (row, error) in zip(dates, results):
+    if error is not None:
+        print(f'{date} の睡眠データの取得に失敗しました: {error}')
+        failed = True
+    elif row is not None:
+        sleep_data.append(row)
+
+if not sleep_data:
+    if failed:
+        sys.exit(1)
+    print('新しい睡眠データはありません')
+    sys.exit(0)
 
 df = pd.DataFrame(sleep_data)
-df['dateOfSleep'] = pd.to_datetime(df['dateOfSleep'])
+df['dateOfSleep'] = pd.to_datetime(df['dateOfSleep'], format='%Y-%m-%d')
 
 # 'date'カラムをインデックスとして設定
 df.set_index('dateOfSleep', inplace=True)
 
-df.to_csv(OUT_FILE)
+os.makedirs(DATA_DIR, exist_ok=True)
+if not os.path.exists(OUT_FILE):
+    df.to_csv(OUT_FILE)
+else:
+    # 取得期間より前の行は変わらないので、パースせずにテキストのまま書き戻す
+    with open(OUT_FILE, 'r') as f:
+        header, *lines = f.read().splitlines()
+    window_start = start_date.isoformat()
+    old_lines = [line for line in lines if line[:10] < window_start]
+    recent_lines = [line for line in lines if line[:10] >= window_start]
+
+    # 取得期間内の行だけ読み込み、同じ日付は今回取得した方を残す
+    recent_df = pd.read_csv(io.StringIO('\n'.join([header] + recent_lines)),
+                            index_col='dateOfSleep', parse_dates=['dateOfSleep'])
+    master_columns = recent_df.columns
+
+    # 書き戻す行と列を揃えるため、マスターにない列は保存できない
+    dropped = sorted(set(df.columns) - set(master_columns))
+    missing = sorted(set(master_columns) - set(df.columns))
+    if dropped:
+        print(f'警告: マスターにない列は保存されません: {dropped}')
+    if missing:
+        print(f'警告: 取得したデータにない列は空欄になります: {missing}')
+
+    df = pd.concat([recent_df, df.reindex(columns=master_columns)])
+    df = df[~df.index.duplicated(keep='last')].sort_index()
+
+    with open(OUT_FILE, 'w') as f:
+        f.write('\n'.join([header] + old_lines) + '\n')
+        df.to_csv(f, header=False)
+
+if failed:
+    sys.exit(1)
 